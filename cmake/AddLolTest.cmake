@@ -1,5 +1,13 @@
 INCLUDE(ParseArguments)
 
+# Sets VAR to VALUE quoted as a JSON string
+FUNCTION(LOL_JSON_STRING VAR VALUE)
+  STRING(REPLACE "\\" "\\\\" VALUE "${VALUE}")
+  STRING(REPLACE "\"" "\\\"" VALUE "${VALUE}")
+  STRING(REPLACE "\n" "\\n" VALUE "${VALUE}")
+  SET(${VAR} "\"${VALUE}\"" PARENT_SCOPE)
+ENDFUNCTION()
+
 FUNCTION(ADD_LOL_TEST TEST_NAME)
   PARSE_ARGUMENTS(ARG "LOLCODE;OUTPUT;INPUT" "ERROR" ${ARGN})
 
@@ -7,7 +15,35 @@ FUNCTION(ADD_LOL_TEST TEST_NAME)
     SET(ARG_LOLCODE ${CMAKE_CURRENT_SOURCE_DIR}/test.lol)
   ENDIF(NOT ARG_LOLCODE)
 
-  SET( TEST_COMMAND python ${CMAKE_SOURCE_DIR}/test/testDriver.py ${CMAKE_BINARY_DIR}/lci ${ARG_LOLCODE} )
+  IF(BATCH_LOL_TESTS)
+    # Record the test in the manifest run by the batch driver
+    LOL_JSON_STRING(NAME_JSON "${TEST_NAME}")
+    LOL_JSON_STRING(LOLCODE_JSON "${ARG_LOLCODE}")
+    SET(TEST_SPEC "{\"name\": ${NAME_JSON}, \"lolcode\": ${LOLCODE_JSON}")
+
+    IF(ARG_OUTPUT)
+      LOL_JSON_STRING(OUTPUT_JSON "${CMAKE_CURRENT_SOURCE_DIR}/${ARG_OUTPUT}")
+      SET(TEST_SPEC "${TEST_SPEC}, \"output\": ${OUTPUT_JSON}")
+    ENDIF(ARG_OUTPUT)
+
+    IF(ARG_INPUT)
+      LOL_JSON_STRING(INPUT_JSON "${CMAKE_CURRENT_SOURCE_DIR}/${ARG_INPUT}")
+      SET(TEST_SPEC "${TEST_SPEC}, \"input\": ${INPUT_JSON}")
+    ENDIF(ARG_INPUT)
+
+    IF(ARG_ERROR)
+      SET(TEST_SPEC "${TEST_SPEC}, \"error\": true")
+    ENDIF(ARG_ERROR)
+
+    FILE(APPEND ${LOL_TEST_MANIFEST} "${TEST_SPEC}}\n")
+    RETURN()
+  ENDIF(BATCH_LOL_TESTS)
+
+  IF(LOL_TEST_SOCKET)
+    SET( TEST_COMMAND testDriverClient ${LOL_TEST_SOCKET} ${CMAKE_BINARY_DIR}/lci ${ARG_LOLCODE} )
+  ELSE(LOL_TEST_SOCKET)
+    SET( TEST_COMMAND ${LOL_TEST_DRIVER} ${CMAKE_BINARY_DIR}/lci ${ARG_LOLCODE} )
+  ENDIF(LOL_TEST_SOCKET)
 
   IF(ARG_OUTPUT)
     LIST(APPEND TEST_COMMAND -o=${CMAKE_CURRENT_SOURCE_DIR}/${ARG_OUTPUT})
@@ -27,4 +63,8 @@ FUNCTION(ADD_LOL_TEST TEST_NAME)
 
   ADD_TEST(NAME ${TEST_NAME} COMMAND ${TEST_COMMAND})
 
+  IF(LOL_TEST_SOCKET)
+    SET_TESTS_PROPERTIES(${TEST_NAME} PROPERTIES FIXTURES_REQUIRED testDriver)
+  ENDIF(LOL_TEST_SOCKET)
+
 ENDFUNCTION()
@@ -1,99 +1,257 @@
 #!/usr/bin/python
 import subprocess
 import argparse
+import hashlib
 import sys
 import os
 
-# Checks if a string is a positive integer
+# Where the arguments of the last configure are recorded
+ARGS_FILE = ".lci_install_args"
+# How much of the end of a failed stage's output to display
+TAIL_SIZE = 4096
+
+# Checks if a string is a positive integer, keeping it as
+# a string since it is only ever passed on to make and ctest.
+# It is written back out in plain digits so that anything else
+# int() accepts, such as " 2" or "+2", isn't passed on as is.
 def positiveInt(string):
   value = int(string)
   if not value >= 1:
     msg = string + " is not a positive integer"
     raise argparse.ArgumentTypeError(msg)
-  return value
+  return str(value)
+
+"""
+Opens the file name for a subprocess's output to be written
+to and returns its descriptor. If it can't be opened, the
+problem is displayed and the script exits.
+"""
+def openLog(name):
+  try:
+    return os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  except OSError as e:
+    print("Error installing: Could not open " + name + ": " + e.strerror)
+    sys.exit(1)
 
 """
-Runs a subprocess using the command parameter.
-Before running the command it displays a message
-that contains the provided description and where
-the output will be sent. If an error occurs,
-the errorMsg is displayed.
+Starts a subprocess using the command parameter and
+returns it, along with the files its output is sent to,
+without waiting for it to finish. Before starting the
+command it displays a message that contains the
+provided description and where the output will be sent.
+Errors are written to errOutput, or to the output file
+name with ".err" added if it isn't given. With --quiet
+the output is discarded instead. If the command can't be
+started at all, the problem is displayed and the script
+exits.
 """
-def runSubProc(command, description, errorMsg, output):
-  msg = description
-  msg += "and writing results to " + output +"."
-  print(msg + "\n")
-
-  outputFile = open(output, "w")
-  if os.name == "nt":
-    proc = subprocess.Popen(command, stdout=outputFile, stderr=subprocess.STDOUT, shell=True)
+def runSubProc(command, description, output, errOutput=None):
+  if errOutput == None:
+    errOutput = output + ".err"
+  if devNull != None:
+    output = errOutput = None
+    where = "discarding results"
+  else:
+    where = "writing results to " + output + " and errors to " + errOutput
+  # One write for the whole message rather than one per piece
+  sys.stdout.write(description + "and " + where + ".\n\n")
+  sys.stdout.flush()
+
+  if output == None:
+    stdout = stderr = devNull.fileno()
   else:
-    proc = subprocess.Popen(command, stdout=outputFile, stderr=subprocess.STDOUT, shell=True)
-  proc.wait()
-  if proc.returncode != 0:
+    # Open the logs here rather than in the child, so a log that
+    # can't be written is reported as such rather than as the tool
+    stdout = openLog(output)
+    stderr = openLog(errOutput)
+
+  try:
+    if hasattr(os, "posix_spawnp"):
+      # Spawn the tool without forking this process; the process is
+      # its pid
+      fileActions = [
+        (os.POSIX_SPAWN_DUP2, stdout, 1),
+        (os.POSIX_SPAWN_DUP2, stderr, 2)]
+      return os.posix_spawnp(command[0], command, os.environ, file_actions=fileActions), output, errOutput
+
+    # Run the tool directly rather than through a shell per stage
+    proc = subprocess.Popen(command, stdout=stdout, stderr=stderr, shell=False)
+    return proc, output, errOutput
+  except OSError as e:
+    # Such as the tool not being installed
+    print("Error installing: Could not run " + command[0] + ": " + str(e))
+    sys.exit(1)
+  finally:
+    # The child has its own copies of the descriptors
+    if output != None:
+      os.close(stdout)
+      os.close(stderr)
+
+"""
+Waits for a subprocess started by runSubProc to
+finish and returns its exit code.
+"""
+def waitExitCode(proc):
+  if isinstance(proc, int):
+    status = os.waitpid(proc, 0)[1]
+    if os.WIFSIGNALED(status):
+      return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+  return proc.wait()
+
+"""
+Displays the last TAIL_SIZE bytes of the files output
+and errOutput on stderr, or how to see them if they were
+discarded. Reading them back from the files once a stage
+has failed avoids passing all of its output through
+Python while it runs.
+"""
+def showTail(output, errOutput):
+  if output == None:
+    sys.stderr.write("Run again without --quiet to see the output.\n")
+    return
+  for name in (output, errOutput):
+    with open(name, "rb") as f:
+      f.seek(0, os.SEEK_END)
+      f.seek(max(0, f.tell() - TAIL_SIZE))
+      tail = f.read()
+    if tail:
+      sys.stderr.write("Last output in " + name + ":\n" + tail.decode("utf-8", "replace") + "\n")
+
+"""
+Waits for each subprocess started by runSubProc in
+procs, a list of (subprocess, errorMsg) pairs, to finish.
+If an error occurs, the errorMsg and the end of the
+output of the first subprocess that failed are displayed.
+"""
+def waitProcs(procs):
+  exitCodes = {}
+  pids = [stage[0] for stage, errorMsg in procs if isinstance(stage[0], int)]
+  if hasattr(os, "waitid"):
+    # Reap the spawned processes in whichever order they
+    # finish, with a single call for each one
+    while len(exitCodes) < len(pids):
+      info = os.waitid(os.P_ALL, 0, os.WEXITED)
+      if info.si_code == os.CLD_EXITED:
+        exitCodes[info.si_pid] = info.si_status
+      else:
+        exitCodes[info.si_pid] = -info.si_status
+
+  failed = None
+  for (proc, output, errOutput), errorMsg in procs:
+    if isinstance(proc, int) and proc in exitCodes:
+      exitCode = exitCodes[proc]
+    else:
+      exitCode = waitExitCode(proc)
+    if exitCode != 0 and failed == None:
+      failed = (output, errOutput, errorMsg)
+  if failed != None:
+    output, errOutput, errorMsg = failed
     print("Error installing: " + errorMsg)
+    sys.stdout.flush()
+    showTail(output, errOutput)
     sys.exit(1)
 
-# Remove the CMakeCache.txt so we can garuntee a fresh configure
-if os.path.exists("CMakeCache.txt"):
-  os.remove("CMakeCache.txt")
+"""
+Waits for a subprocess started by runSubProc to
+finish. If an error occurs, the errorMsg is displayed.
+"""
+def waitProc(proc, errorMsg):
+  waitProcs([(proc, errorMsg)])
 
 parser = argparse.ArgumentParser(description="Installation script for lci")
 parser.add_argument('-p', '--prefix', default=None, help="Installation prefix")
 parser.add_argument('-m', '--enableMemCheck', action="store_true", help="Enable memory testing")
 parser.add_argument('-d', '--buildDocs', action="store_true", help="Build documentation")
 parser.add_argument('-t', '--runTests', action="store_true", help="Run Tests")
-parser.add_argument('-j', metavar="NumProcs", type=positiveInt, default=1, help="Number of processes for make to use and (if enabled) how many processes CTest should use.")
+parser.add_argument('-q', '--quiet', action="store_true", help="Discard the output of each step instead of writing it to a file")
+parser.add_argument('-j', metavar="NumProcs", type=positiveInt, default="1", help="Number of processes for make to use and (if enabled) how many processes CTest should use.")
 
 args = parser.parse_args()
-j = str(args.j)
+
+# Opened once and shared by every step when output is discarded
+devNull = None
+if args.quiet:
+  devNull = open(os.devnull, "wb")
 
 cmakeCommand = ["cmake"]
 makeCommand = "make"
 
 # Support for Windows
 if os.name == "nt":
-  cmakeCommand.append("-G \"MinGW Makefiles\"")
+  cmakeCommand += ["-G", "MinGW Makefiles"]
   makeCommand = "mingw32-make"
 
 if args.prefix != None:
-  cmakeCommand.append("-DCMAKE_INSTALL_PREFIX:STRING=\""+args.prefix+"\"")
+  cmakeCommand.append("-DCMAKE_INSTALL_PREFIX:STRING="+args.prefix)
 if args.enableMemCheck:
   cmakeCommand.append("-DPERFORM_MEM_TESTS:BOOL=ON")
 cmakeCommand.append(".")
 
-# Windows does weird things if this is not joined...
-cmakeCommand = " ".join(cmakeCommand)
+# The arguments the last successful configure was run with are
+# kept next to the cache, so an unchanged configure can be skipped.
+# Only the ones passed on to cmake count; changing -j, for
+# example, doesn't need a new configure.
+cmakeArgs = {"prefix": args.prefix, "enableMemCheck": args.enableMemCheck}
+argsHash = hashlib.sha256(repr(sorted(cmakeArgs.items())).encode()).hexdigest()
+lastArgsHash = None
+if os.path.exists(ARGS_FILE):
+  with open(ARGS_FILE) as f:
+    lastArgsHash = f.read().strip()
 
-runSubProc(
-  cmakeCommand,
-  "Running cmake with command: \n\"" + cmakeCommand + "\"\n",
-  "There was a CMake error",
-  "configure.out")
+if argsHash == lastArgsHash and os.path.exists("CMakeCache.txt"):
+  sys.stdout.write("CMake arguments are unchanged, skipping cmake.\n\n")
+  sys.stdout.flush()
+else:
+  # Remove the CMakeCache.txt so we can garuntee a fresh configure
+  if os.path.exists("CMakeCache.txt"):
+    os.remove("CMakeCache.txt")
+  # Forget the last arguments too, so a configure that fails after
+  # writing a new cache isn't skipped the next time
+  if os.path.exists(ARGS_FILE):
+    os.remove(ARGS_FILE)
 
-runSubProc(
-  [makeCommand, "-j"+j],
-  "Running make ",
-  "There was a make error",
-  "make.out")
+  waitProc(
+    runSubProc(
+      cmakeCommand,
+      "Running cmake with command: \n\"" + subprocess.list2cmdline(cmakeCommand) + "\"\n",
+      "configure.out"),
+    "There was a CMake error")
 
+  with open(ARGS_FILE, "w") as f:
+    f.write(argsHash + "\n")
 
-if args.buildDocs:
+waitProc(
   runSubProc(
-    [makeCommand, "-j"+j, "docs"],
-    "Building documentation ",
-    "There was a documentation building error",
-    "docs.out")
+    [makeCommand, "-j"+args.j],
+    "Running make ",
+    "make.out"),
+  "There was a make error")
 
-runSubProc(
-  makeCommand + " install",
+# Installing and building documentation only depend on
+# the build, so run them at the same time
+installProc = runSubProc(
+  [makeCommand, "install"],
   "Installing ",
-  "There was an installation error",
   "install.out")
 
+docsProc = None
+if args.buildDocs:
+  docsProc = runSubProc(
+    [makeCommand, "-j"+args.j, "docs"],
+    "Building documentation ",
+    "docs.out")
+
+# Let both finish before reporting so neither is left running
+procs = [(installProc, "There was an installation error")]
+if docsProc != None:
+  procs.append((docsProc, "There was a documentation building error"))
+waitProcs(procs)
+
 if args.runTests:
-  runSubProc(
-    ["ctest", "-j"+j],
-    "Testing ",
-    "There was a testing error",
-    "test.out")
+  waitProc(
+    runSubProc(
+      ["ctest", "-j"+args.j],
+      "Testing ",
+      "test.out"),
+    "There was a testing error")
@@ -0,0 +1,24 @@
+"""
+Compiles testDriver.py and testDriverServer.py into C extensions
+with mypyc and installs the lci_testdriver command, which runs the
+same driver without interpreting its argument parsing and output
+checking. To install it from the top of the lci source tree and
+have CMake run the tests with it instead of "python testDriver.py":
+
+  $ pip install ./test
+  $ cmake -DUSE_COMPILED_TEST_DRIVER:BOOL=ON .
+
+Reinstall it after changing either file.
+"""
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+  name="lci_testdriver",
+  version="0.10.5",
+  description="Compiled driver for the lci tests",
+  ext_modules=mypycify(["testDriver.py", "testDriverServer.py"]),
+  entry_points={
+    "console_scripts": ["lci_testdriver = testDriver:main"],
+  },
+)
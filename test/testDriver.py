@@ -1,87 +1,562 @@
 #!/usr/bin/python
-import subprocess
+from __future__ import annotations
 import sys
+import os
+import io
+import types
+import mmap
 import tempfile
-import argparse
+
+# The typing names are only needed to check (or compile) the
+# driver, so importing them is left out of each test run
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+  from typing import Any, Dict, List, NoReturn, Optional, Tuple
 
 MEMERR = 127
-  
-parser = argparse.ArgumentParser(description="Driver for lci tests")
-parser.add_argument('pathToLCI', help="The absolute path the the lci executable")
-parser.add_argument('lolcodeFile', help="The absolute path to the lolcode file to test")
-parser.add_argument('-o', '--outputFile', type=argparse.FileType('r'), default=None, help="The expected output")
-parser.add_argument('-i', '--inputFile', type=argparse.FileType('r'), default=None, help="File to be used as input")
-parser.add_argument('-e', '--expectError', action="store_true", help="Specify that an error should occur")
-parser.add_argument('-m', '--memCheck', action='store_true', help="Do a memory check")
-
-args = parser.parse_args()
-
-
-if args.inputFile == None:
-  print("Not using an input file")
-else:
-  print("Using input file: " + args.inputFile.name) 
-
-if args.expectError:
-  print("Expecting an error") 
-else:
-  print("Not expecting an error")
-
-if args.outputFile == None:
-  print("Not using an output file")
-else:
-  print("Using output file: " + args.outputFile.name) 
-
-if args.memCheck:
-  print("Doing memory check.")
-else:
-  print("Not doing memory check.")
-
-expectedOutput = ""
-if args.outputFile != None:
-  expectedOutput = args.outputFile.read()
-  args.outputFile.close()
-
-command = []
-if args.memCheck:
-  command.append("valgrind")
-  command.append("-q")
-  command.append("--leak-check=full")
-  command.append("--error-exitcode=" + str(MEMERR))
-command.append(args.pathToLCI)
-command.append(args.lolcodeFile)
-
-print("Command: " + " ".join(command))
-
-p = subprocess.Popen(command, stdin=args.inputFile, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-results = p.communicate()
-
-if p.returncode == MEMERR:
-  print("Failure!\n Memory leak detected, check output for more information.)")
-  sys.exit(1)
-
-if args.expectError:
-  if p.returncode == 0:
-    print("Failure! Expected an error but did not recieve one")
-    sys.exit(1)
+# Size of the chunks that output from lci is read in
+READ_SIZE = 65536
+
+USAGE = """usage: testDriver.py [-h] [-o OUTPUTFILE] [-i INPUTFILE] [-e] [-m]
+                     [--manifest MANIFEST] [--serve SOCKET] [--stop SOCKET]
+                     [pathToLCI] [lolcodeFile]
+"""
+
+HELP = USAGE + """
+Driver for lci tests
+
+positional arguments:
+  pathToLCI             The absolute path the the lci executable
+  lolcodeFile           The absolute path to the lolcode file to test
+
+options:
+  -h, --help            show this help message and exit
+  -o OUTPUTFILE, --outputFile OUTPUTFILE
+                        The expected output
+  -i INPUTFILE, --inputFile INPUTFILE
+                        File to be used as input
+  -e, --expectError     Specify that an error should occur
+  -m, --memCheck        Do a memory check
+  --manifest MANIFEST   Run every test listed in this file instead of a
+                        single lolcode file
+  --serve SOCKET        Start a server on this Unix socket that runs tests
+                        sent by testDriverClient
+  --stop SOCKET         Stop the server listening on this Unix socket
+"""
+
+# Options that take a value and the argument each one sets
+VALUE_OPTIONS = {
+  "-o": "outputFile", "--outputFile": "outputFile",
+  "-i": "inputFile", "--inputFile": "inputFile",
+  "--manifest": "manifest",
+  "--serve": "serve",
+  "--stop": "stop"}
+
+# Options that are switched on by being present
+FLAG_OPTIONS = {
+  "-h": "help", "--help": "help",
+  "-e": "expectError", "--expectError": "expectError",
+  "-m": "memCheck", "--memCheck": "memCheck"}
+
+POSITIONAL_ARGS = ["pathToLCI", "lolcodeFile"]
+
+"""
+Parses the command line arguments in argv. Values may be
+given as "-o FILE" or "-o=FILE". Returns an object with an
+attribute for each argument, which is None (or False for
+flags) if it wasn't given. Raises a ValueError describing
+the problem if the arguments can't be parsed.
+
+This is done by hand rather than with argparse to keep the
+start up of each test run short.
+"""
+def parseArgs(argv: List[str]) -> types.SimpleNamespace:
+  args = types.SimpleNamespace()
+  for name in POSITIONAL_ARGS + list(VALUE_OPTIONS.values()):
+    setattr(args, name, None)
+  for name in FLAG_OPTIONS.values():
+    setattr(args, name, False)
+
+  positional = []
+  i = 0
+  while i < len(argv):
+    arg = argv[i]
+    i += 1
+    option, equals, value = arg.partition("=")
+    if option in VALUE_OPTIONS:
+      if not equals:
+        if i == len(argv):
+          raise ValueError("argument " + option + ": expected one argument")
+        value = argv[i]
+        i += 1
+      setattr(args, VALUE_OPTIONS[option], value)
+    elif arg in FLAG_OPTIONS:
+      setattr(args, FLAG_OPTIONS[arg], True)
+    elif arg.startswith("-") and arg != "-":
+      raise ValueError("unrecognized argument: " + arg)
+    else:
+      positional.append(arg)
+
+  if len(positional) > len(POSITIONAL_ARGS):
+    raise ValueError("unrecognized arguments: " + " ".join(positional[len(POSITIONAL_ARGS):]))
+  for name, value in zip(POSITIONAL_ARGS, positional):
+    setattr(args, name, value)
+  return args
+
+"""
+Displays the usage and msg on stderr and exits the way
+argparse would.
+"""
+def usageError(msg: str) -> NoReturn:
+  sys.stderr.write(USAGE + "testDriver.py: error: " + msg + "\n")
+  sys.exit(2)
+
+"""
+Checks that the file path given for option can be read,
+reporting a usage error the way argparse would if it can't.
+"""
+def checkFile(option: str, path: Optional[str]) -> None:
+  if path == None:
+    return
+  try:
+    open(path, "rb").close()
+  except OSError as e:
+    usageError("argument " + option + ": can't open '" + path + "': " + str(e))
+
+"""
+Checks whether the contents of outputFile, an open file
+holding the output of lci, are the same as expectedOutput.
+The file is mapped and compared in place rather than read
+into a new bytes object.
+"""
+def outputMatches(outputFile: io.BufferedIOBase, expectedOutput: bytes) -> bool:
+  size = os.fstat(outputFile.fileno()).st_size
+  if size != len(expectedOutput):
+    return False
+  if size == 0:
+    # Empty files can't be mapped
+    return True
+  mm = mmap.mmap(outputFile.fileno(), 0, access=mmap.ACCESS_READ)
+  view = memoryview(mm)
+  try:
+    return view == expectedOutput
+  finally:
+    view.release()
+    mm.close()
+
+"""
+Returns the SHA-256 digest of the rest of the open file f,
+reading it a chunk at a time rather than all at once.
+"""
+def hashFile(f: io.BufferedIOBase) -> bytes:
+  import hashlib
+  sha = hashlib.sha256()
+  chunk = memoryview(bytearray(READ_SIZE))
+  while True:
+    n = f.readinto(chunk)
+    if not n:
+      break
+    sha.update(chunk[:n])
+  return sha.digest()
+
+"""
+Reads from the pipe f until it is closed and returns what
+was read. Each read goes into the same chunk buffer and is
+appended to a single bytearray, rather than allocating a
+new bytes object per read and joining them at the end.
+"""
+def drain(f: io.RawIOBase) -> bytearray:
+  data = bytearray()
+  chunk = memoryview(bytearray(READ_SIZE))
+  while True:
+    n = f.readinto(chunk)
+    if not n:
+      break
+    data += chunk[:n]
+  return data
+
+"""
+Runs command with its input read from the file inputFile
+(or inherited if None), its output written to the open file
+stdout and its errors captured. Returns the exit code of
+the command and what it wrote to stderr.
+"""
+def spawn(command: List[str], inputFile: Optional[str], stdout: io.BufferedIOBase) -> Tuple[int, bytearray]:
+  # Open the input here rather than in the child, so a missing
+  # input file is reported as such rather than as a missing command
+  stdin = None
+  if inputFile != None:
+    stdin = os.open(inputFile, os.O_RDONLY)
+  errRead, errWrite = os.pipe()
+  try:
+    if not hasattr(os, "posix_spawnp"):
+      import subprocess
+      with os.fdopen(errRead, "rb", 0) as errFile:
+        try:
+          p = subprocess.Popen(command, stdin=stdin, stdout=stdout.fileno(), stderr=errWrite)
+        finally:
+          os.close(errWrite)
+        errors = drain(errFile)
+      p.wait()
+      return p.returncode, errors
+
+    # Spawn without forking this process, letting the child set up
+    # its own input and output
+    fileActions: List[Tuple[Any, ...]] = [
+      (os.POSIX_SPAWN_DUP2, stdout.fileno(), 1),
+      (os.POSIX_SPAWN_DUP2, errWrite, 2)]
+    if stdin != None:
+      fileActions.append((os.POSIX_SPAWN_DUP2, stdin, 0))
+    with os.fdopen(errRead, "rb", 0) as errFile:
+      try:
+        pid = os.posix_spawnp(command[0], command, os.environ, file_actions=fileActions)
+      finally:
+        os.close(errWrite)
+      errors = drain(errFile)
+  finally:
+    if stdin != None:
+      os.close(stdin)
+
+  status = os.waitpid(pid, 0)[1]
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status), errors
+  return os.WEXITSTATUS(status), errors
+
+"""
+Runs lci on a single lolcode file and checks the result.
+outputFile and inputFile are paths to the expected output
+and to the file used as input, or None if not used.
+If expectedHash, the SHA-256 digest of the expected output,
+is given, the output of lci is checked against it instead of
+against the contents of outputFile, which are then only read
+to report a mismatch.
+Returns whether the test passed along with the lines
+describing what happened.
+"""
+def runTest(pathToLCI: str, lolcodeFile: str, outputFile: Optional[str], inputFile: Optional[str],
+    expectError: bool, memCheck: bool, expectedHash: Optional[bytes] = None) -> Tuple[bool, List[str]]:
+  lines = []
+
+  if inputFile == None:
+    lines.append("Not using an input file")
   else:
-    print("Success!")
-    print("Error:")
-    print(results[1])
- 
-if args.outputFile:
-  if p.returncode != 0:
-    print("Failure! Return error code: " + str(p.returncode))
-    sys.exit(1)
-  elif expectedOutput != results[0]:
-    print("Expected output didn't match!")
-    print("Expected output:")
-    print(expectedOutput)
-    print("Actual output:")
-    print(results[0])
-    sys.exit(1)
+    lines.append("Using input file: " + inputFile)
+
+  if expectError:
+    lines.append("Expecting an error")
+  else:
+    lines.append("Not expecting an error")
+
+  if outputFile == None:
+    lines.append("Not using an output file")
+  else:
+    lines.append("Using output file: " + outputFile)
+
+  if memCheck:
+    lines.append("Doing memory check.")
+  else:
+    lines.append("Not doing memory check.")
+
+  command = []
+  if memCheck:
+    command.append("valgrind")
+    command.append("-q")
+    command.append("--leak-check=full")
+    command.append("--error-exitcode=" + str(MEMERR))
+  command.append(pathToLCI)
+  command.append(lolcodeFile)
+
+  lines.append("Command: " + " ".join(command))
+
+  # lci writes its output straight into a temporary file rather
+  # than through a pipe that has to be drained chunk by chunk
+  stdout = tempfile.TemporaryFile()
+  returncode, errors = spawn(command, inputFile, stdout)
+
+  if returncode == MEMERR:
+    stdout.close()
+    lines.append("Failure!\n Memory leak detected, check output for more information.)")
+    return False, lines
+
+  try:
+    if expectError:
+      if returncode == 0:
+        lines.append("Failure! Expected an error but did not recieve one")
+        return False, lines
+      else:
+        lines.append("Success!")
+        lines.append("Error:")
+        lines.append(errors.decode("utf-8", "replace"))
+
+    if outputFile != None:
+      if returncode != 0:
+        lines.append("Failure! Return error code: " + str(returncode))
+        return False, lines
+      if expectedHash != None:
+        stdout.seek(0)
+        matches = hashFile(stdout) == expectedHash
+        expectedOutput = None
+      else:
+        # Only read the expected output once there is something to
+        # compare it with, as bytes to match the raw output of lci
+        with open(outputFile, "rb") as f:
+          expectedOutput = f.read()
+        matches = outputMatches(stdout, expectedOutput)
+      if not matches:
+        if expectedOutput == None:
+          with open(outputFile, "rb") as f:
+            expectedOutput = f.read()
+        stdout.seek(0)
+        lines.append("Expected output didn't match!")
+        lines.append("Expected output:")
+        lines.append(expectedOutput.decode("utf-8", "replace"))
+        lines.append("Actual output:")
+        lines.append(stdout.read().decode("utf-8", "replace"))
+        return False, lines
+      lines.append("Success!\n\n")
+  finally:
+    stdout.close()
+
+  return True, lines
+
+"""
+One entry of a test manifest: the name of the test, the
+lolcode file to run and optionally the expected output file,
+the input file and whether an error is expected.
+"""
+class TestSpec:
+  def __init__(self, name: str, lolcode: str, output: Optional[str], input: Optional[str], error: bool) -> None:
+    self.name = name
+    self.lolcode = lolcode
+    self.output = output
+    self.input = input
+    self.error = error
+
+  # Sent to the worker processes by its arguments, since a class
+  # compiled with mypyc can't otherwise be rebuilt without them
+  def __reduce__(self) -> Tuple[Any, ...]:
+    return TestSpec, (self.name, self.lolcode, self.output, self.input, self.error)
+
+"""
+Runs the test described by spec, checking its output against
+expectedHash if it has an expected output. Returns the name
+of the test, whether it passed and the lines describing what
+happened.
+"""
+def runManifestTest(pathToLCI: str, memCheck: bool, spec: TestSpec, expectedHash: Optional[bytes]) -> Tuple[str, bool, List[str]]:
+  passed, lines = runTest(
+    pathToLCI,
+    spec.lolcode,
+    spec.output,
+    spec.input,
+    spec.error,
+    memCheck,
+    expectedHash)
+  return spec.name, passed, lines
+
+"""
+Runs every test listed in a manifest file (one JSON object
+per line) across a pool of worker processes and prints a
+summary. Returns whether all of the tests passed.
+"""
+def runManifest(pathToLCI: str, manifestFile: str, memCheck: bool) -> bool:
+  # Only imported here, so running a single test doesn't pay for them
+  import json
+  import concurrent.futures
+  specs = []
+  with open(manifestFile) as f:
+    for line in f:
+      if line.strip():
+        test = json.loads(line)
+        specs.append(TestSpec(
+          test["name"],
+          test["lolcode"],
+          test.get("output"),
+          test.get("input"),
+          test.get("error", False)))
+
+  # Hash each expected output once up front, so the workers
+  # only need its digest rather than a copy of the output
+  expectedHashes: Dict[str, bytes] = {}
+  for spec in specs:
+    if spec.output != None and spec.output not in expectedHashes:
+      try:
+        with open(spec.output, "rb") as f:
+          expectedHashes[spec.output] = hashFile(f)
+      except OSError:
+        # Left for the test itself to fail on and report
+        pass
+
+  failures = 0
+  # Processes rather than threads so comparing results in one
+  # worker doesn't hold up the others on the GIL. The default
+  # number of workers already uses every CPU, within the limit
+  # Windows puts on it.
+  with concurrent.futures.ProcessPoolExecutor() as pool:
+    futures = []
+    for spec in specs:
+      expectedHash = None
+      if spec.output != None:
+        expectedHash = expectedHashes.get(spec.output)
+      futures.append(pool.submit(runManifestTest, pathToLCI, memCheck, spec, expectedHash))
+    for spec, future in zip(specs, futures):
+      try:
+        name, passed, lines = future.result()
+      except Exception as e:
+        # Such as lci or one of the test's files being missing; count
+        # the test as failed and carry on with the rest
+        name, passed, lines = spec.name, False, ["Error: " + str(e)]
+      if not passed:
+        failures += 1
+        sys.stdout.write("Test " + name + " failed:\n" + "\n".join(lines) + "\n")
+
+  print(str(len(specs) - failures) + " of " + str(len(specs)) + " tests passed")
+  return failures == 0
+
+"""
+Runs the test described by argv, the arguments sent to the
+test driver server, and returns whether it passed along with
+the lines describing what happened. Raises a ValueError if
+the arguments aren't valid.
+"""
+def runRequest(argv: List[str]) -> Tuple[bool, List[str]]:
+  try:
+    args = parseArgs(argv)
+  except ValueError:
+    args = None
+  if args == None or args.pathToLCI == None or args.lolcodeFile == None:
+    raise ValueError("Invalid test arguments: " + " ".join(argv))
+  # The server runs in the socket's directory rather than the
+  # client's, so relative paths would point at the wrong files
+  for path in (args.pathToLCI, args.lolcodeFile, args.outputFile, args.inputFile):
+    if path != None and not os.path.isabs(path):
+      raise ValueError("Paths sent to the test driver must be absolute: " + path)
+
+  return runTest(
+    args.pathToLCI,
+    args.lolcodeFile,
+    args.outputFile,
+    args.inputFile,
+    args.expectError,
+    args.memCheck)
+
+"""
+Starts a test driver server listening on the Unix socket
+socketPath in the background, so that tests can be run
+through testDriverClient without starting Python for each
+one. The server stops by itself once it is idle. Returns
+once the server is accepting connections, or what went wrong
+if it couldn't be started.
+"""
+def serve(socketPath: str) -> Optional[str]:
+  directory, name = os.path.split(os.path.abspath(socketPath))
+  readyRead, readyWrite = os.pipe()
+  if os.fork() != 0:
+    os.close(readyWrite)
+    # Either "1" once the server is ready or what went wrong
+    reply = b""
+    while True:
+      data = os.read(readyRead, READ_SIZE)
+      if not data:
+        break
+      reply += data
+    os.close(readyRead)
+    if reply == b"1":
+      return None
+    return reply.decode("utf-8", "replace") or "the server exited"
+
+  os.close(readyRead)
+  try:
+    try:
+      # Detach so whatever started us (such as CTest) doesn't
+      # wait on the server
+      os.setsid()
+      os.closerange(3, readyWrite)
+      os.closerange(readyWrite + 1, os.sysconf("SC_OPEN_MAX"))
+      # Imported here, so only the server pays for socketserver
+      import testDriverServer
+      # Bind relative to the socket's directory to keep long build
+      # directories within the limit on socket path lengths
+      os.chdir(directory)
+      if os.path.exists(name):
+        os.remove(name)
+      server = testDriverServer.TestDriverServer(name, runRequest)
+      inode = os.stat(name).st_ino
+    except Exception as e:
+      # Nothing is listening for the server's own errors, so send
+      # the problem back to be displayed
+      os.write(readyWrite, str(e).encode("utf-8", "replace"))
+      os._exit(1)
+    # Only let go of the output once the server is listening, so
+    # problems starting it aren't lost
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+      os.dup2(devnull, fd)
+    os.close(devnull)
+    os.write(readyWrite, b"1")
+    os.close(readyWrite)
+    server.run()
+    server.server_close()
+    # A newer server may have replaced the socket in the meantime
+    if os.stat(name).st_ino == inode:
+      os.remove(name)
+  finally:
+    os._exit(0)
+
+"""
+Asks the test driver server listening on socketPath to stop.
+"""
+def stop(socketPath: str) -> None:
+  import socket
+  directory, name = os.path.split(os.path.abspath(socketPath))
+  os.chdir(directory)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.connect(name)
+  sock.sendall(b"--stop\0")
+  sock.shutdown(socket.SHUT_WR)
+  sock.recv(1)
+  sock.close()
+
+"""
+Runs the test driver with the command line arguments. This
+is also the entry point of the compiled lci_testdriver
+command (see setup.py).
+"""
+def main() -> None:
+  try:
+    args = parseArgs(sys.argv[1:])
+  except ValueError as e:
+    usageError(str(e))
+
+  if args.help:
+    sys.stdout.write(HELP)
+  elif args.serve != None:
+    problem = serve(args.serve)
+    if problem != None:
+      print("Could not start the test driver server on " + args.serve + ": " + problem)
+      sys.exit(1)
+  elif args.stop != None:
+    stop(args.stop)
+  elif args.pathToLCI == None:
+    usageError("the path to lci is required")
+  elif args.manifest != None:
+    if not runManifest(args.pathToLCI, args.manifest, args.memCheck):
+      sys.exit(1)
+  elif args.lolcodeFile == None:
+    usageError("either a lolcode file or --manifest is required")
   else:
-    print("Success!\n\n")
+    checkFile("-o/--outputFile", args.outputFile)
+    checkFile("-i/--inputFile", args.inputFile)
+    passed, lines = runTest(
+      args.pathToLCI,
+      args.lolcodeFile,
+      args.outputFile,
+      args.inputFile,
+      args.expectError,
+      args.memCheck)
+    sys.stdout.write("\n".join(lines) + "\n")
+    if not passed:
+      sys.exit(1)
 
-if args.inputFile !=None:
-  args.inputFile
+if __name__ == "__main__":
+  main()
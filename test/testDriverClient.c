@@ -0,0 +1,108 @@
+/**
+ * A client for the test driver server started with "testDriver.py --serve".
+ * It passes its arguments on to the server, prints the report that comes back
+ * and exits with the result of the test.  This lets each test run without
+ * starting a Python interpreter of its own.
+ *
+ * Usage: testDriverClient SOCKET pathToLCI lolcodeFile [testDriver options]
+ *
+ * The paths given must be absolute, since the server runs in the socket's
+ * directory rather than this one.
+ *
+ * The request is the arguments after SOCKET, each terminated by a NUL byte.
+ * The reply is a single '0' (passed) or '1' (failed) followed by the report.
+ *
+ * \file   testDriverClient.c
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+
+#define READSIZE 4096
+
+/**
+ * Writes all \a len bytes of \a buf to \a fd.
+ *
+ * \return 0 on success or -1 on failure.
+ */
+static int writeAll(int fd, const char *buf, size_t len)
+{
+	ssize_t n;
+	while (len > 0) {
+		n = write(fd, buf, len);
+		if (n < 0) return -1;
+		buf += n;
+		len -= (size_t)n;
+	}
+	return 0;
+}
+
+int main(int argc, char **argv)
+{
+	struct sockaddr_un addr;
+	char buf[READSIZE];
+	char *name = NULL;
+	int status = -1;
+	ssize_t n;
+	int fd;
+	int i;
+
+	if (argc < 3) {
+		fprintf(stderr, "Usage: %s SOCKET pathToLCI lolcodeFile [options]\n", argv[0]);
+		return EXIT_FAILURE;
+	}
+
+	/* Connect relative to the socket's directory to keep long build
+	 * directories within the limit on socket path lengths */
+	name = strrchr(argv[1], '/');
+	if (name) {
+		*name++ = '\0';
+		if (chdir(*argv[1] ? argv[1] : "/")) {
+			perror(argv[1]);
+			return EXIT_FAILURE;
+		}
+	}
+	else name = argv[1];
+
+	if (strlen(name) >= sizeof(addr.sun_path)) {
+		fprintf(stderr, "%s: socket name too long\n", name);
+		return EXIT_FAILURE;
+	}
+	memset(&addr, 0, sizeof(addr));
+	addr.sun_family = AF_UNIX;
+	strcpy(addr.sun_path, name);
+
+	fd = socket(AF_UNIX, SOCK_STREAM, 0);
+	if (fd < 0 || connect(fd, (struct sockaddr *)&addr, sizeof(addr))) {
+		perror("Could not connect to the test driver");
+		return EXIT_FAILURE;
+	}
+
+	for (i = 2; i < argc; i++) {
+		if (writeAll(fd, argv[i], strlen(argv[i]) + 1)) {
+			perror("Could not send the test to the test driver");
+			return EXIT_FAILURE;
+		}
+	}
+	shutdown(fd, SHUT_WR);
+
+	while ((n = read(fd, buf, READSIZE)) > 0) {
+		i = 0;
+		if (status < 0) {
+			status = (buf[0] == '0') ? EXIT_SUCCESS : EXIT_FAILURE;
+			i = 1;
+		}
+		fwrite(buf + i, 1, (size_t)(n - i), stdout);
+	}
+	close(fd);
+
+	if (status < 0) {
+		fprintf(stderr, "The test driver closed the connection without a result\n");
+		return EXIT_FAILURE;
+	}
+	return status;
+}
@@ -0,0 +1,77 @@
+"""
+The test driver server started by "testDriver.py --serve". It is
+kept apart from testDriver.py so that running a single test or a
+batch doesn't have to import socketserver and threading.
+"""
+import os
+import socketserver
+import threading
+import time
+from typing import Any, Callable, List, Tuple, cast
+
+# Seconds without any tests to run before the server stops
+IDLE_TIMEOUT = 10
+
+"""
+Handles one connection to the test driver server. The request
+is the arguments of a single test, each terminated by a NUL
+byte, as sent by testDriverClient. The reply is "0" if the test
+passed or "1" if it failed, followed by its report.
+"""
+class TestRequestHandler(socketserver.StreamRequestHandler):
+  def handle(self) -> None:
+    argv = [os.fsdecode(arg) for arg in self.rfile.read().split(b"\0")[:-1]]
+    server = cast(TestDriverServer, self.server)
+    if argv == ["--stop"]:
+      server.stopping = True
+      return
+
+    try:
+      passed, lines = server.runRequest(argv)
+    except Exception as e:
+      # The server's own stderr goes nowhere, so send the problem
+      # (such as a missing lci or test file) back as the report
+      passed, lines = False, ["Error: " + str(e)]
+    if passed:
+      self.wfile.write(b"0")
+    else:
+      self.wfile.write(b"1")
+    self.wfile.write(("\n".join(lines) + "\n").encode("utf-8", "replace"))
+
+"""
+Serves the requests handled by TestRequestHandler, each on its
+own thread, running each test with runRequest. It stops when
+asked to or once it has had nothing to do for IDLE_TIMEOUT
+seconds, so it doesn't outlive the test run that started it.
+"""
+class TestDriverServer(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
+  # How often to check whether the server has gone idle
+  timeout = 1
+
+  def __init__(self, name: str, runRequest: Callable[[List[str]], Tuple[bool, List[str]]]) -> None:
+    socketserver.ThreadingUnixStreamServer.__init__(self, name, TestRequestHandler)
+    self.runRequest = runRequest
+    self.stopping = False
+    self.active = 0
+    self.lastActive = time.time()
+    self.lock = threading.Lock()
+
+  def process_request(self, request: Any, clientAddress: Any) -> None:
+    with self.lock:
+      self.active += 1
+    socketserver.ThreadingUnixStreamServer.process_request(self, request, clientAddress)
+
+  def shutdown_request(self, request: Any) -> None:
+    socketserver.ThreadingUnixStreamServer.shutdown_request(self, request)
+    with self.lock:
+      self.active -= 1
+      self.lastActive = time.time()
+
+  def idle(self) -> bool:
+    with self.lock:
+      return self.active == 0 and time.time() - self.lastActive > IDLE_TIMEOUT
+
+  def run(self) -> None:
+    while not self.stopping and not self.idle():
+      self.handle_request()